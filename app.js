@@ -7,6 +7,7 @@ class StreamingApp {
     constructor() {
         // WebRTC Connection
         this.peerConnection = null;
+        this.syncChannel = null;
         this.isConnected = false;
         this.receivedTracks = 0;
         this.reconnectAttempts = 0;
@@ -25,7 +26,8 @@ class StreamingApp {
         this.stats = {
             video: { fps: 0, bitrate: 0, resolution: '', bytesReceived: 0 },
             audio: { bitrate: 0, bytesReceived: 0 },
-            connection: { type: '', latency: 0 }
+            connection: { type: '', latency: 0 },
+            sync: { targetDelay: null, syncError: null, jitterBuffer: null }
         };
         
         // Intervals
@@ -240,6 +242,9 @@ class StreamingApp {
             this.peerConnection.addTransceiver('video', { direction: 'recvonly' });
             this.peerConnection.addTransceiver('audio', { direction: 'recvonly' });
             
+            // Playout sync channel (must exist before the offer to be negotiated)
+            this.setupSyncChannel();
+            
             // Create and send offer
             const offer = await this.peerConnection.createOffer();
             await this.peerConnection.setLocalDescription(offer);
@@ -345,6 +350,64 @@ class StreamingApp {
         });
     }
     
+    /**
+     * Setup the data channel used for server-coordinated playout sync
+     */
+    setupSyncChannel() {
+        this.syncChannel = this.peerConnection.createDataChannel('sync');
+        
+        this.syncChannel.addEventListener('message', (event) => {
+            let message;
+            try {
+                message = JSON.parse(event.data);
+            } catch (error) {
+                console.error('Invalid sync message:', error);
+                return;
+            }
+            
+            switch (message.type) {
+                case 'ping':
+                    // Echo server timestamp so the server can measure RTT
+                    this.sendSyncMessage({ type: 'pong', server_time: message.server_time });
+                    break;
+                case 'sync':
+                    this.applyPlayoutTarget(message);
+                    break;
+            }
+        });
+    }
+    
+    sendSyncMessage(message) {
+        if (this.syncChannel && this.syncChannel.readyState === 'open') {
+            this.syncChannel.send(JSON.stringify(message));
+        }
+    }
+    
+    /**
+     * Apply the server's common playout delay to all receivers
+     */
+    applyPlayoutTarget(message) {
+        if (!this.peerConnection) return;
+        
+        // jitterBufferTarget throws RangeError outside [0, 4000] ms
+        const targetMs = Math.min(Math.max(Number(message.jitter_buffer_target_ms) || 0, 0), 4000);
+        this.peerConnection.getReceivers().forEach(receiver => {
+            try {
+                if ('jitterBufferTarget' in receiver) {
+                    receiver.jitterBufferTarget = targetMs;
+                } else if ('playoutDelayHint' in receiver) {
+                    receiver.playoutDelayHint = targetMs / 1000;
+                }
+            } catch (error) {
+                console.error('Failed to apply playout target:', error);
+            }
+        });
+        
+        this.stats.sync.targetDelay = message.target_delay_ms;
+        this.stats.sync.syncError = message.sync_error_ms;
+        this.statusElements.latency.textContent = `${Math.round(message.delay_ms)} ms`;
+    }
+    
     /**
      * Handle connection errors and implement reconnection logic
      */
@@ -554,6 +617,43 @@ class StreamingApp {
             this.statusElements.videoBitrate.textContent = `${bitrate} kbps`;
         }
         this.stats.video.lastBytesReceived = report.bytesReceived;
+        
+        this.reportJitterBuffer(report);
+    }
+    
+    /**
+     * Report jitter buffer delay to the server for playout sync
+     */
+    reportJitterBuffer(report) {
+        const last = this.stats.video.lastJitterBuffer;
+        this.stats.video.lastJitterBuffer = {
+            delay: report.jitterBufferDelay,
+            minimumDelay: report.jitterBufferMinimumDelay,
+            emitted: report.jitterBufferEmittedCount
+        };
+        
+        if (!last || !report.jitterBufferEmittedCount) return;
+        
+        const emittedDiff = report.jitterBufferEmittedCount - last.emitted;
+        if (emittedDiff <= 0) return;
+        
+        // Stats are cumulative seconds; convert the per-frame average to ms
+        const jitterBufferMs = ((report.jitterBufferDelay - last.delay) / emittedDiff) * 1000;
+        const message = { type: 'report', jitter_buffer_ms: jitterBufferMs };
+        
+        // Playout time mapped to our local clock from the RTCP SR, lets the server measure real delay
+        if (report.estimatedPlayoutTimestamp !== undefined) {
+            message.playout_timestamp = report.estimatedPlayoutTimestamp;
+            message.stats_time = report.timestamp;
+        }
+        
+        // Minimum delay excludes our own jitterBufferTarget, so the target doesn't ratchet up
+        if (report.jitterBufferMinimumDelay !== undefined && last.minimumDelay !== undefined) {
+            message.min_jitter_buffer_ms = ((report.jitterBufferMinimumDelay - last.minimumDelay) / emittedDiff) * 1000;
+        }
+        
+        this.stats.sync.jitterBuffer = jitterBufferMs;
+        this.sendSyncMessage(message);
     }
     
     updateAudioStats(report) {
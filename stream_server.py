@@ -1,6 +1,7 @@
 import asyncio
 import json
 import logging
+import math
 import os
 import uuid
 import fractions
@@ -29,6 +30,13 @@ HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", "8080"))
 RTMP_URL = os.getenv("RTMP_URL", "rtmp://localhost:1935/live/stream")
 USE_HARDWARE_ACCELERATION = os.getenv("USE_HARDWARE_ACCELERATION", "false").lower() == "true"
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "1.0"))  # Senkronizasyon turu aralığı (sn)
+SYNC_MAX_DELAY_MS = float(os.getenv("SYNC_MAX_DELAY_MS", "4000"))  # Ortak oynatma gecikmesi üst sınırı
+JITTER_BUFFER_TARGET_MAX_MS = 4000.0  # Tarayıcı jitterBufferTarget üst sınırı (daha büyüğü RangeError verir)
+SYNC_HYSTERESIS_MS = 20.0  # Hedefler bu kadar değişmedikçe yeniden gönderilmez
+MAX_REPORTED_BUFFER_MS = JITTER_BUFFER_TARGET_MAX_MS + 1000.0  # Bunun üzerindeki tampon raporları reddedilir
+# İstemci raporlarını 1 sn'lik istatistik zamanlayıcısıyla gönderir; SYNC_INTERVAL'dan bağımsızdır
+SYNC_REPORT_TIMEOUT = max(5 * SYNC_INTERVAL, 5.0)
 
 # FFmpeg command
 # Bu komut RTMP akışını H.264 video ve PCM ses formatına dönüştürür,
@@ -74,6 +82,7 @@ FFMPEG_COMMAND = get_ffmpeg_command()
 # --- Globals ---
 pcs: Set[RTCPeerConnection] = set()
 relay = None
+sync_coordinator = None
 web_app = web.Application()
 
 # --- Logging ---
@@ -89,16 +98,32 @@ class VideoRelayTrack(VideoStreamTrack):
     """
     def __init__(self):
         super().__init__()
-        self._queue: asyncio.Queue[Optional[Frame]] = asyncio.Queue(maxsize=180)  # ~3 sn @ 60 fps
+        # Her frame, demux edildiği andaki sunucu duvar saati ile damgalanır
+        self._queue: asyncio.Queue[Optional[Tuple[Frame, float]]] = asyncio.Queue(maxsize=180)  # ~3 sn @ 60 fps
         self._last_warning_ts: float = 0.0
+        self._queue_delay_ms: float = 0.0
+
+    @property
+    def queue_delay_ms(self) -> float:
+        """
+        Frame'lerin relay kuyruğunda beklediği süre (EWMA, ms).
+
+        Track tüm eşler arasında paylaşıldığı için bu tek, global bir değerdir; her izleyicinin
+        gecikmesine aynı miktar eklenir ve hizalamada birbirini götürür. Sadece /sync
+        metriklerinde uçtan uca gecikmeyi göstermek için kullanılır.
+        """
+        return self._queue_delay_ms
 
     async def recv(self) -> Frame:
-        frame = await self._queue.get()
-        if frame is None:
+        item = await self._queue.get()
+        if item is None:
             raise asyncio.CancelledError
+        frame, ingest_ts = item
+        delay_ms = (time.time() - ingest_ts) * 1000
+        self._queue_delay_ms = 0.9 * self._queue_delay_ms + 0.1 * delay_ms
         return frame
 
-    def push(self, frame: Frame):
+    def push(self, frame: Frame, ingest_ts: Optional[float] = None):
         """
         Decode edilmiş video frame'ini WebRTC pipeline'ına gönder.
         """
@@ -106,6 +131,9 @@ class VideoRelayTrack(VideoStreamTrack):
         if len(pcs) == 0:
             return  # İzleyen yoksa sessizce düşür
 
+        if ingest_ts is None:
+            ingest_ts = time.time()
+
         if self._queue.full():
             # Kuyruk doluysa, sadece en eski frame'i at
             try:
@@ -118,7 +146,7 @@ class VideoRelayTrack(VideoStreamTrack):
                 pass
 
         try:
-            self._queue.put_nowait(frame)
+            self._queue.put_nowait((frame, ingest_ts))
         except asyncio.QueueFull:
             pass
 
@@ -435,7 +463,7 @@ class MediaRelay:
 
                         if isinstance(frame, VideoFrame) and self._video_track:
                             frame_count += 1
-                            loop.call_soon_threadsafe(self._video_track.push, frame)
+                            loop.call_soon_threadsafe(self._video_track.push, frame, time.time())
                             
                         elif isinstance(frame, AudioFrame) and self._audio_track:
                             audio_frame_count += 1
@@ -511,6 +539,302 @@ class MediaRelay:
         logger.info("FFmpeg stderr izleme tamamlandı.")
 
 
+# --- Playout Sync ---
+
+NTP_EPOCH_OFFSET_MS = 2208988800000  # 1900-01-01 (NTP) ile 1970-01-01 (Unix) arası fark
+
+
+class PeerSyncState:
+    """
+    Tek bir izleyicinin gecikme ölçümlerini tutar.
+    """
+    def __init__(self, pc_id: str, channel):
+        self.pc_id = pc_id
+        self.channel = channel
+        self.rtt_ms: Optional[float] = None
+        self.jitter_buffer_ms: Optional[float] = None      # Tarayıcının fiili tampon gecikmesi
+        self.min_jitter_buffer_ms: Optional[float] = None  # Hedef uygulanmadan ulaşılabilecek tampon gecikmesi
+        self.playout_overhead_ms: Optional[float] = None   # Ölçülen oynatma gecikmesinin tampon dışı kısmı (EWMA)
+        self.buffer_target_ms: float = 0.0                 # İstemciye en son gönderilen tampon hedefi
+        self._natural_buffer_ms: Optional[float] = None    # jitterBufferMinimumDelay yoksa kullanılan tahmin
+        self.last_report_ts: float = 0.0
+        self.sync_error_ms: Optional[float] = None
+        self.drift_ms_per_s: float = 0.0
+        self._last_error_ts: Optional[float] = None
+        self._last_warning_ts: float = 0.0
+
+    @property
+    def measured(self) -> bool:
+        """Gecikme, tarayıcının gerçek oynatma zamanından mı ölçülüyor."""
+        return self.playout_overhead_ms is not None
+
+    def is_ready(self, now: float) -> bool:
+        return ((self.measured or self.rtt_ms is not None)
+                and self.jitter_buffer_ms is not None
+                and now - self.last_report_ts < SYNC_REPORT_TIMEOUT)
+
+    def update_playout(self, playout_ntp_ms: Optional[float], stats_time_ms: Optional[float]):
+        """
+        Tarayıcının estimatedPlayoutTimestamp değerinden oynatma gecikmesini hesaplar.
+
+        libwebrtc, aiortc'nin RTCP sender report'larındaki NTP zamanını RemoteNtpTimeEstimator
+        ile alıcının yerel saatine çevirir; bu yüzden değer doğrudan istatistik zaman
+        damgasıyla karşılaştırılır, istemci-sunucu saat farkı gerekmez.
+        """
+        if playout_ntp_ms is None or stats_time_ms is None:
+            self.playout_overhead_ms = None
+            return
+        delay_ms = stats_time_ms - (playout_ntp_ms - NTP_EPOCH_OFFSET_MS)
+        if not 0 <= delay_ms <= 60000:
+            # Henüz SR alınmadıysa anlamsız değerler gelir
+            self.playout_overhead_ms = None
+            return
+
+        # Tek bir istatistik örneğinin gürültüsü tampon hedeflerini oynatmasın. Sadece tampon
+        # dışı kısım yumuşatılır; tampon değişiklikleri (uygulanan hedef) hemen yansır.
+        overhead_ms = delay_ms - (self.jitter_buffer_ms or 0.0)
+        if self.playout_overhead_ms is None:
+            self.playout_overhead_ms = overhead_ms
+        else:
+            self.playout_overhead_ms = 0.8 * self.playout_overhead_ms + 0.2 * overhead_ms
+
+        if self.rtt_ms is not None and self.jitter_buffer_ms is not None:
+            estimate_ms = self.rtt_ms / 2 + self.jitter_buffer_ms
+            now = time.time()
+            if abs(delay_ms - estimate_ms) > 500 and now - self._last_warning_ts > 10:
+                logger.warning(f"{self.pc_id} Ölçülen oynatma gecikmesi ({delay_ms:.0f} ms) "
+                               f"RTT/2 + tampon tahmininden ({estimate_ms:.0f} ms) çok farklı.")
+                self._last_warning_ts = now
+
+    def update_jitter_buffer(self, jitter_buffer_ms: float):
+        """
+        Raporlanan tampon gecikmesini kaydeder ve doğal tampon tahminini günceller.
+
+        jitterBufferTarget/playoutDelayHint bir alt sınırdır: tampon yaklaşık
+        max(doğal, hedef) olur. Tampon hedefin belirgin şekilde üzerindeyse doğal değerdir;
+        hedefte duruyorsa doğal değer bilinemez, önceki tahmin yavaşça azaltılarak tutulur
+        ki yavaş izleyici iyileştiğinde ortak hedef de düşebilsin.
+        """
+        self.jitter_buffer_ms = jitter_buffer_ms
+        if (self._natural_buffer_ms is None
+                or self.buffer_target_ms <= 0
+                or jitter_buffer_ms > self.buffer_target_ms + SYNC_HYSTERESIS_MS):
+            self._natural_buffer_ms = jitter_buffer_ms
+        else:
+            self._natural_buffer_ms *= 0.99
+
+    def natural_buffer_ms(self) -> float:
+        """Sunucunun eklediği hedef olmadan tarayıcının tutacağı tampon gecikmesi."""
+        if self.min_jitter_buffer_ms is not None:
+            return self.min_jitter_buffer_ms
+        if self._natural_buffer_ms is not None:
+            return self._natural_buffer_ms
+        return self.jitter_buffer_ms or 0.0
+
+    def delay_ms(self, queue_delay_ms: float) -> float:
+        """
+        Bu izleyicinin şu anki uçtan uca gecikmesi (demux'tan ekrana).
+
+        Ölçüm yoksa relay kuyruğu + RTT/2 + tampon tahminine düşer.
+        """
+        if self.playout_overhead_ms is not None:
+            return queue_delay_ms + self.playout_overhead_ms + (self.jitter_buffer_ms or 0.0)
+        return queue_delay_ms + (self.rtt_ms or 0.0) / 2 + (self.jitter_buffer_ms or 0.0)
+
+    def natural_delay_ms(self, queue_delay_ms: float) -> float:
+        """Ek tamponlama olmadan bu izleyicinin ulaşabileceği en düşük uçtan uca gecikme."""
+        extra_buffer_ms = (self.jitter_buffer_ms or 0.0) - self.natural_buffer_ms()
+        return self.delay_ms(queue_delay_ms) - extra_buffer_ms
+
+    def non_buffer_delay_ms(self, queue_delay_ms: float) -> float:
+        """Gecikmenin tarayıcı tamponu dışında kalan kısmı (kuyruk, kodlama, ağ, çözme, çizim)."""
+        return self.delay_ms(queue_delay_ms) - (self.jitter_buffer_ms or 0.0)
+
+    def update_sync_error(self, error_ms: float, now: float):
+        if self.sync_error_ms is not None and self._last_error_ts is not None and now > self._last_error_ts:
+            slope = (error_ms - self.sync_error_ms) / (now - self._last_error_ts)
+            if math.isfinite(slope):
+                self.drift_ms_per_s = 0.8 * self.drift_ms_per_s + 0.2 * slope
+        self.sync_error_ms = error_ms
+        self._last_error_ts = now
+
+
+class SyncCoordinator:
+    """
+    Tüm izleyicilerin aynı anda oynatması için ortak bir hedef oynatma gecikmesi belirler.
+
+    Her izleyiciyle 'sync' data channel'ı üzerinden konuşur: sunucu ping atarak RTT'yi
+    ölçer, istemci tampon gecikmesini ve estimatedPlayoutTimestamp
+    değerini raporlar. Hedef gecikme, en yavaş izleyicinin ulaşabileceği en düşük
+    gecikmedir; diğer izleyiciler tamponlarını bu hedefe göre büyütür.
+    """
+    def __init__(self):
+        self._peers: Dict[RTCPeerConnection, PeerSyncState] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._target_delay_ms: Optional[float] = None
+
+    def add_peer(self, pc: RTCPeerConnection, pc_id: str, channel):
+        state = PeerSyncState(pc_id, channel)
+        self._peers[pc] = state
+
+        @channel.on("message")
+        def on_message(message):
+            self._handle_message(state, message)
+
+        @channel.on("close")
+        def on_close():
+            self.remove_peer(pc)
+
+    def remove_peer(self, pc: RTCPeerConnection):
+        self._peers.pop(pc, None)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+        logger.info("SyncCoordinator başlatıldı.")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._peers.clear()
+
+    @staticmethod
+    def _number(value) -> Optional[float]:
+        """
+        İstemciden gelen değeri sonlu bir sayıya çevirir; NaN/Infinity ve sayı olmayanları reddeder.
+        """
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        value = float(value)
+        return value if math.isfinite(value) else None
+
+    def _handle_message(self, state: PeerSyncState, message):
+        try:
+            data = json.loads(message)
+        except (TypeError, ValueError):
+            data = None
+        if not isinstance(data, dict):
+            logger.warning(f"{state.pc_id} Geçersiz sync mesajı: {message!r}")
+            return
+
+        msg_type = data.get("type")
+        if msg_type == "pong":
+            sent_ts = self._number(data.get("server_time"))
+            if sent_ts is None:
+                return
+            rtt_ms = (time.time() - sent_ts) * 1000
+            if not 0 <= rtt_ms <= 10000:
+                return  # Bizim göndermediğimiz ya da çok eski bir ping
+            state.rtt_ms = rtt_ms if state.rtt_ms is None else 0.8 * state.rtt_ms + 0.2 * rtt_ms
+        elif msg_type == "report":
+            jitter_buffer_ms = self._number(data.get("jitter_buffer_ms"))
+            min_jitter_buffer_ms = self._number(data.get("min_jitter_buffer_ms"))
+            if jitter_buffer_ms is not None and 0 <= jitter_buffer_ms <= MAX_REPORTED_BUFFER_MS:
+                state.update_jitter_buffer(jitter_buffer_ms)
+                state.last_report_ts = time.time()
+            if min_jitter_buffer_ms is not None and 0 <= min_jitter_buffer_ms <= MAX_REPORTED_BUFFER_MS:
+                state.min_jitter_buffer_ms = min_jitter_buffer_ms
+            state.update_playout(self._number(data.get("playout_timestamp")),
+                                 self._number(data.get("stats_time")))
+
+    def _send(self, state: PeerSyncState, payload: dict):
+        if state.channel.readyState != "open":
+            return
+        try:
+            state.channel.send(json.dumps(payload, allow_nan=False))
+        except Exception as e:
+            logger.warning(f"{state.pc_id} Sync mesajı gönderilemedi: {e}")
+
+    def _queue_delay_ms(self) -> float:
+        # Global kuyruk gecikmesi: raporlanan gecikmeleri etkiler, tampon hedeflerini etkilemez
+        if relay and relay.video_track:
+            return relay.video_track.queue_delay_ms
+        return 0.0
+
+    async def _run(self):
+        while True:
+            try:
+                self._tick()
+            except Exception as e:
+                logger.error(f"Sync turu sırasında hata: {e}")
+                logger.error(f"Traceback: {traceback.format_exc()}")
+            await asyncio.sleep(SYNC_INTERVAL)
+
+    def _tick(self):
+        """
+        RTT ölçümü için ping atar, hedef gecikmeyi yeniden hesaplar ve izleyicilere bildirir.
+        """
+        now = time.time()
+        queue_delay_ms = self._queue_delay_ms()
+        ready = [state for state in self._peers.values() if state.is_ready(now)]
+
+        if ready:
+            # En yavaş izleyicinin izin verdiği en düşük gecikme
+            target = min(max(state.natural_delay_ms(queue_delay_ms) for state in ready), SYNC_MAX_DELAY_MS)
+            # Küçük dalgalanmalar tüm odanın tamponlarını oynatmasın
+            if self._target_delay_ms is None or abs(target - self._target_delay_ms) >= SYNC_HYSTERESIS_MS:
+                self._target_delay_ms = target
+        else:
+            self._target_delay_ms = None
+
+        for state in list(self._peers.values()):
+            self._send(state, {"type": "ping", "server_time": now})
+
+            if self._target_delay_ms is None or state not in ready:
+                continue
+
+            delay_ms = state.delay_ms(queue_delay_ms)
+            state.update_sync_error(delay_ms - self._target_delay_ms, now)
+            buffer_target_ms = self._target_delay_ms - state.non_buffer_delay_ms(queue_delay_ms)
+            buffer_target_ms = min(max(buffer_target_ms, 0.0), JITTER_BUFFER_TARGET_MAX_MS)
+            if abs(buffer_target_ms - state.buffer_target_ms) >= SYNC_HYSTERESIS_MS:
+                state.buffer_target_ms = buffer_target_ms
+            self._send(state, {
+                "type": "sync",
+                "server_time": now,
+                "target_delay_ms": round(self._target_delay_ms, 1),
+                "jitter_buffer_target_ms": round(state.buffer_target_ms, 1),
+                "delay_ms": round(delay_ms, 1),
+                "sync_error_ms": round(state.sync_error_ms, 1),
+                "measured": state.measured,
+            })
+
+    def metrics(self) -> dict:
+        """
+        Senkronizasyon metriklerini döndürür: hedef gecikme, izleyici başına hata ve kayma.
+        """
+        now = time.time()
+        queue_delay_ms = self._queue_delay_ms()
+        peers = []
+        for state in self._peers.values():
+            ready = state.is_ready(now)
+            peers.append({
+                "peer": state.pc_id,
+                "ready": ready,
+                "measured": state.measured,
+                "rtt_ms": round(state.rtt_ms, 1) if state.rtt_ms is not None else None,
+                "jitter_buffer_ms": round(state.jitter_buffer_ms, 1) if state.jitter_buffer_ms is not None else None,
+                "jitter_buffer_target_ms": round(state.buffer_target_ms, 1),
+                "delay_ms": round(state.delay_ms(queue_delay_ms), 1) if ready else None,
+                "sync_error_ms": round(state.sync_error_ms, 1) if state.sync_error_ms is not None else None,
+                "drift_ms_per_s": round(state.drift_ms_per_s, 2),
+            })
+
+        errors = [abs(p["sync_error_ms"]) for p in peers if p["ready"] and p["sync_error_ms"] is not None]
+        delays = [p["delay_ms"] for p in peers if p["delay_ms"] is not None]
+        return {
+            "target_delay_ms": round(self._target_delay_ms, 1) if self._target_delay_ms is not None else None,
+            "relay_queue_delay_ms": round(queue_delay_ms, 1),
+            "max_sync_error_ms": max(errors) if errors else None,
+            "viewer_spread_ms": round(max(delays) - min(delays), 1) if len(delays) > 1 else None,
+            "peers": peers,
+        }
+
+
 # --- Static Files Directory ---
 STATIC_DIR = os.path.join(ROOT, '.')
 
@@ -545,8 +869,17 @@ async def offer(request):
             log_info("Peer connection kapatılıyor.")
             if pc in pcs:
                 pcs.discard(pc)
+            if sync_coordinator:
+                sync_coordinator.remove_peer(pc)
             await pc.close()
 
+    @pc.on("datachannel")
+    def on_datachannel(channel):
+        # İstemci, oynatma senkronizasyonu için 'sync' kanalını offer'dan önce açar
+        if channel.label == "sync" and sync_coordinator:
+            sync_coordinator.add_peer(pc, pc_id, channel)
+            log_info("Sync data channel açıldı")
+
     # Relay'den track'leri ekle
     tracks_added = []
     if relay and relay.video_track:
@@ -591,6 +924,14 @@ async def health(request):
         "audio_track_available": relay and relay.audio_track is not None,
         "restart_count": relay._restart_count if relay else 0,
     }
+
+    if sync_coordinator:
+        sync_metrics = sync_coordinator.metrics()
+        health_data["sync"] = {
+            "target_delay_ms": sync_metrics["target_delay_ms"],
+            "max_sync_error_ms": sync_metrics["max_sync_error_ms"],
+            "viewer_spread_ms": sync_metrics["viewer_spread_ms"],
+        }
     
     status_code = 200 if health_data["status"] == "healthy" else 503
     
@@ -600,6 +941,16 @@ async def health(request):
         status=status_code
     )
 
+async def sync_metrics(request):
+    """
+    İzleyiciler arası oynatma senkronizasyonu metriklerini döndürür.
+    """
+    data = sync_coordinator.metrics() if sync_coordinator else {}
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps(data, allow_nan=False),
+    )
+
 
 async def on_shutdown(app):
     """
@@ -609,6 +960,9 @@ async def on_shutdown(app):
     coros = [pc.close() for pc in pcs]
     await asyncio.gather(*coros)
     pcs.clear()
+
+    if sync_coordinator:
+        await sync_coordinator.stop()
     
     # Media relay'i ve FFmpeg sürecini durdur
     if relay:
@@ -619,11 +973,14 @@ async def on_startup(app):
     """
     aiohttp uygulaması başlarken kaynakları başlat.
     """
-    global relay
+    global relay, sync_coordinator
     relay = MediaRelay()
     loop = asyncio.get_running_loop()
     relay.start(loop)
 
+    sync_coordinator = SyncCoordinator()
+    sync_coordinator.start()
+
 # Static dosyalar için handler
 async def static_file(request):
     """Static dosyaları serve et"""
@@ -655,6 +1012,7 @@ async def static_file(request):
 web_app.router.add_get("/", index)
 web_app.router.add_post("/offer", offer)
 web_app.router.add_get("/health", health)
+web_app.router.add_get("/sync", sync_metrics)
 web_app.router.add_get("/{filename}", static_file)
 
 # Startup ve shutdown handler'ları ekle